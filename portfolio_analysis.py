@@ -1,5 +1,100 @@
 import numpy as np
 import pandas as pd
+
+try:
+    import numba
+except ImportError:  # numba is optional; pure numpy paths are used without it
+    numba = None
+
+if numba is not None:
+    # cache=True persists the compiled kernels to __pycache__, so short-lived
+    # backtest processes pay a disk load instead of a cold JIT compile. The
+    # signatures are left lazy: labels arrive as int8/int16/int32 depending on
+    # the portfolio count, and the cache stores each compiled variant.
+    @numba.njit(parallel=True, cache=True)
+    def _bin_codes_kernel(values, breakpoints, codes):
+        # Same bins as np.digitize(values, breakpoints, right=True), binary
+        # search per element, parallelized across samples. Writes into the
+        # caller-allocated codes array, which fixes the output dtype.
+        for i in numba.prange(values.shape[0]):
+            if np.isnan(values[i]):
+                codes[i] = -1  # missing characteristic: belongs to no portfolio
+            else:
+                codes[i] = np.searchsorted(breakpoints, values[i], side='left')
+
+    @numba.njit(cache=True)
+    def _group_average_kernel(labels, outcome, weight, p):
+        # Fused weighted scatter-add: avoids the outcome*weight temporary.
+        num = np.zeros(p)
+        den = np.zeros(p)
+        for i in range(labels.shape[0]):
+            w = weight[i]
+            num[labels[i]] += outcome[i] * w
+            den[labels[i]] += w
+        return num / den
+
+def _code_dtype(num_codes: int) -> type:
+    '''Smallest signed integer dtype that can hold codes 0..num_codes-1.'''
+    if num_codes <= np.iinfo(np.int8).max + 1:
+        return np.int8
+    if num_codes <= np.iinfo(np.int16).max + 1:
+        return np.int16
+    return np.int32
+
+
+def _partition_percentiles(values: np.ndarray, percentiles: tuple) -> np.ndarray:
+    '''
+    Compute a handful of percentiles with np.partition instead of a full sort.
+
+    Matches np.percentile: same linear interpolation, and any NaN in values
+    makes every breakpoint NaN. Runs in O(n*k) rather than O(n log n), which
+    wins when only a few cutoffs are needed.
+    '''
+    pos = np.asarray(percentiles, dtype=np.float64) / 100.0 * (values.shape[0] - 1)
+    if np.isnan(values).any():
+        # np.partition pushes NaN to the end, which would silently bias the
+        # cutoffs upward; propagate NaN the way np.percentile does instead.
+        return np.full(pos.shape, np.nan)
+    lo = np.floor(pos).astype(np.intp)
+    hi = np.ceil(pos).astype(np.intp)
+    ranks = np.unique(np.concatenate((lo, hi)))
+    part = np.partition(values, ranks)
+    return part[lo] + (pos - lo) * (part[hi] - part[lo])
+
+
+def assign(character: np.ndarray, percentiles) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Fused breakpoint-and-label kernel for a single sort feature.
+
+    Computes the interior quantile breakpoints and bins every sample in one
+    function body, so the column is read from RAM once and is still cache-hot
+    when it is labelled, instead of being scanned again between breakpoint()
+    and portfolio_formation().
+
+    Args:
+        character (np.ndarray): Sample values of the sort feature.
+        percentiles: Percentiles; 0, 100 and duplicates are dropped.
+
+    Returns:
+        (tuple): integer bin code per sample, and the breakpoints used.
+    '''
+    character = np.asarray(character, dtype=np.float64)
+    q = np.unique(np.asarray(percentiles, dtype=np.float64))
+    q = q[(q > 0) & (q < 100)]
+    if len(q) <= 16:
+        breaks = _partition_percentiles(character, tuple(q))
+    else:
+        breaks = np.percentile(character, q)
+    dtype = _code_dtype(len(breaks) + 1)
+    if numba is not None:
+        codes = np.empty(character.shape[0], dtype=dtype)
+        _bin_codes_kernel(character, breaks, codes)
+    else:
+        codes = np.digitize(character, breaks, right=True).astype(dtype)
+        codes[np.isnan(character)] = -1
+    return codes, breaks
+
+
 '''
 The univariate portfolio analysis procedure has four steps.
  - The first step is to calculate the breakpoints that will be used to divide the sample into portfolios. 
@@ -16,6 +111,11 @@ class PortfolioAnalysis():
             raise ValueError("Not DataFrame format")
         
         self.df = dataframe  # initial dataframe
+        # Memoized breakpoints, keyed by (feature, percentile tuple). Valid as
+        # long as the underlying column is not mutated; build a fresh
+        # PortfolioAnalysis per rebalancing date (the usual pattern) or clear
+        # this dict after editing self.df.
+        self._breakpoint_cache = {}
     
     def breakpoint(self, feature_percentiles: dict[str, list[int]]) -> dict[str, np.ndarray]:
         '''
@@ -36,78 +136,244 @@ class PortfolioAnalysis():
 
         Raises:
             ValueError: If the provided percentiles are not in list format.
-        '''
 
-        breakpoints_dict = {}
+        Note:
+            Results are cached on the instance per (feature, percentiles);
+            clear self._breakpoint_cache if self.df is mutated in place.
+        '''
 
+        # Validate and sanitize every percentile list up front, before any
+        # data is touched. Interior percentiles only: 0 and 100 add no
+        # breakpoints, so they are dropped along with duplicates.
+        cleaned = {}
         for feature, percentiles_list in feature_percentiles.items():
             if not isinstance(percentiles_list, list):
                 raise ValueError("The provided percentiles are not in list format.")
-            
-            percentiles_list = sorted(percentiles_list)
-            if percentiles_list[0] == 0:
-                percentiles_list.pop(0)
-            if percentiles_list[-1] == 100:
-                percentiles_list.pop(-1)
 
-            breakpoints_dict[feature] = np.percentile(self.dataframe[feature].values, percentiles_list)
-            # Not including zero and 100%
+            percentiles = np.unique(np.asarray(percentiles_list, dtype=np.float64))
+            percentiles = percentiles[(percentiles > 0) & (percentiles < 100)]
+            cleaned[feature] = tuple(percentiles)
+
+        # Batch the features that still need computing and share a percentile
+        # set into a single np.percentile call over a 2-D column block;
+        # serve the rest from the per-instance cache.
+        grouped = {}
+        for feature, percentiles in cleaned.items():
+            if (feature, percentiles) not in self._breakpoint_cache:
+                grouped.setdefault(percentiles, []).append(feature)
+
+        breakpoints_dict = {}
+        for percentiles, features in grouped.items():
+            if len(percentiles) <= 16:
+                # Few cutoffs: an O(n*k) partition beats the full sort
+                # inside np.percentile.
+                for feature in features:
+                    breakpoints_dict[feature] = _partition_percentiles(self.df[feature].values, percentiles)
+            else:
+                result = np.percentile(self.df[features].values, list(percentiles), axis=0)
+                for j, feature in enumerate(features):
+                    breakpoints_dict[feature] = result[:, j]
+
+        for feature, breaks in breakpoints_dict.items():
+            self._breakpoint_cache[(feature, cleaned[feature])] = breaks
 
-        return breakpoints_dict
+        # Preserve the caller's feature order, which portfolio_formation
+        # relies on for the bivariate/multivariate encodings.
+        return {feature: self._breakpoint_cache[(feature, cleaned[feature])] for feature in feature_percentiles}
 
 
 
 
-    def portfolio_formation(self, breakpoints_dict: dict[str, np.ndarray], const: str='bi') -> np.ndarray:
+    def portfolio_formation(self, breakpoints_dict: dict[str, np.ndarray], const: str='bi') -> tuple[np.ndarray, np.ndarray]:
         '''
             The second step is to use these breakpoints to form the portfolios.
             Generate multivariate portfolios based on breakpoints for each feature.
         Args:
             breakpoints_dict (dict): A dictionary where keys represent feature names and values represent lists of breakpoints for each feature.
-            const (str, optional): Type of portfolios to generate. Defaults to 'univariate'. Another is bivariate
-        
-        Returns:
-            np.ndarray: An array where each row represents a sample and each column represents a portfolio label.
+            const (str, optional): Type of portfolios to generate. Defaults to 'bivariate'. Others are 'uni' (univariate) and 'multi' (any number of features, fused into one composite label).
+
+        Returns: (tuple):
+            labels (np.ndarray): 1-D integer array where labels[i] is the portfolio index of sample i, in [0, p).
+            counts (np.ndarray): Number of samples in each of the p portfolios.
 
         Note:
-            This function generates portfolios based on breakpoints provided for each feature. It computes labels for each sample based on these breakpoints and returns an array of portfolio labels.
+            This function generates portfolios based on breakpoints provided for each feature. It computes a flat integer label per sample from these breakpoints; each sample belongs to exactly one portfolio, so no dense sample-by-portfolio matrix is built. Samples with a NaN characteristic get label -1 (the NaN category of the 'portfolio' column) and are excluded from counts and from average_portfolio_values.
+        '''
+
+        # One Fortran-ordered copy of the sort columns: each X[:, k] is then a
+        # contiguous float64 column, so the binning kernels get unit-stride
+        # access instead of refetching through pandas once per feature.
+        X = np.asfortranarray(self.df[list(breakpoints_dict.keys())].to_numpy(dtype=np.float64))
+
+        for k, (feature, breakpoint) in enumerate(breakpoints_dict.items()):
+            # np.digitize on the interior breakpoints gives the same bins as
+            # pd.cut with +/-inf edges, without building an IntervalIndex.
+            values = X[:, k]
+            if isinstance(breakpoint, np.ndarray) and breakpoint.dtype == np.float64:
+                # breakpoint() output: already a contiguous float64 array —
+                # use the view as-is, no per-call rebuild.
+                edges = breakpoint
+            else:
+                edges = np.ascontiguousarray(breakpoint, dtype=np.float64)
+            if np.any(np.diff(edges) < 0):
+                # Only hand-built breakpoints ever pay for this sort; the
+                # O(k) check itself is noise next to the O(n) binning.
+                edges = np.sort(edges)
+            dtype = _code_dtype(len(edges) + 1)
+            if numba is not None:
+                codes = np.empty(values.shape[0], dtype=dtype)
+                _bin_codes_kernel(values, edges, codes)
+                self.df[feature+'_group'] = codes
+            else:
+                codes = np.digitize(values, edges, right=True).astype(dtype)
+                codes[np.isnan(values)] = -1
+                self.df[feature+'_group'] = codes
+
+        bin_counts = {feature: len(breakpoint) + 1 for feature, breakpoint in breakpoints_dict.items()}
+        return self._fuse_group_codes(bin_counts, const)
+
+    def sort_portfolios(self, feature_percentiles: dict[str, list[int]], const: str='bi') -> tuple[np.ndarray, np.ndarray]:
         '''
+        Fused version of breakpoint() followed by portfolio_formation().
 
-        for feature, breakpoint in breakpoints_dict.items():
-            bins = sorted(breakpoint + [-np.inf, np.inf])
-            self.df[feature+'_group'] = pd.cut(self.df[feature], bins=bins, labels=False, right=True)
+        Each feature column is read once: the breakpoints and the bin codes
+        are computed back-to-back by assign() while the column is still hot
+        in cache, rather than in two separate passes over the same data. Use
+        the two-step API when the breakpoints themselves are needed.
 
+        Args:
+            feature_percentiles (dict): Column names mapped to percentile lists, as in breakpoint().
+            const (str, optional): 'uni', 'bi' or 'multi', as in portfolio_formation().
+
+        Returns: (tuple):
+            labels (np.ndarray): 1-D integer array of portfolio codes, one per sample.
+            counts (np.ndarray): Number of samples in each portfolio.
+        '''
+        X = np.asfortranarray(self.df[list(feature_percentiles.keys())].to_numpy(dtype=np.float64))
+
+        bin_counts = {}
+        for k, (feature, percentiles) in enumerate(feature_percentiles.items()):
+            codes, breaks = assign(X[:, k], percentiles)
+            self.df[feature+'_group'] = codes
+            bin_counts[feature] = len(breaks) + 1
+
+        return self._fuse_group_codes(bin_counts, const)
+
+    def _fuse_group_codes(self, bin_counts: dict[str, int], const: str) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Fuse the per-feature _group columns into flat portfolio codes, store
+        them in self.df['portfolio'] and return them with portfolio sizes.
+        '''
+        features = list(bin_counts.keys())
         if const == 'uni':
-            self.df['portfolio'] = self.df[list(breakpoints_dict.keys())[0]+'_group']  
-        if const == 'bi':
-            self.df['portfolio'] = list(zip(self.df[list(breakpoints_dict.keys())[0]+'_group'], self.df[list(breakpoints_dict.keys())[1]+'_group']))
+            codes = self.df[features[0]+'_group'].values
+            p = bin_counts[features[0]]
+        elif const == 'bi':
+            # Flat integer code g0 * n1 + g1 instead of a column of Python
+            # tuples, so downstream aggregation works on a contiguous int array.
+            n0 = bin_counts[features[0]]
+            n1 = bin_counts[features[1]]
+            dtype = _code_dtype(n0 * n1)
+            g0 = self.df[features[0]+'_group'].values.astype(dtype)
+            g1 = self.df[features[1]+'_group'].values.astype(dtype)
+            codes = g0 * dtype(n1) + g1
+            codes[(g0 < 0) | (g1 < 0)] = -1
+            p = n0 * n1
+        elif const == 'multi':
+            # Fuse per-feature bin indices into a single composite integer label
+            # via a mixed-radix encoding, so the result stays a flat (n,) array
+            # regardless of how many features are sorted on.
+            dims = list(bin_counts.values())
+            p = int(np.prod(dims))
+            groups = [self.df[feature+'_group'].values for feature in features]
+            missing = groups[0] < 0
+            for group in groups[1:]:
+                missing |= group < 0
+            codes = np.ravel_multi_index([np.maximum(group, 0) for group in groups], dims=dims).astype(_code_dtype(p))
+            codes[missing] = -1
+        else:
+            raise ValueError(f"Unknown const: {const!r}; expected 'uni', 'bi' or 'multi'")
 
-        return self.df['portfolio'].values
+        # Categorical column over the full code range: groupby('portfolio',
+        # observed=True) then hashes compact integer codes, and empty
+        # portfolios stay representable. Code -1 becomes the NaN category.
+        self.df['portfolio'] = pd.Categorical.from_codes(codes, categories=np.arange(p))
 
-    def average_portfolio_values(self, portfolio_label: np.ndarray, outcome: np.ndarray, weight: np.ndarray=None):
+        if (codes < 0).any():
+            counts = np.bincount(codes[codes >= 0], minlength=p)
+        else:
+            counts = np.bincount(codes, minlength=p)
+        return codes, counts
+
+    def average_portfolio_values(self, portfolio_label: np.ndarray, outcome: np.ndarray, weight: np.ndarray=None, p: int=None):
         """
         Calculate the average values of portfolios.
 
         Args:
-            portfolio_label (np.ndarray): Array of portfolio labels, where each column represents labels for a portfolio.
-            outcome (np.ndarray): Array of outcome values for each portfolio corresponding to portfolio_label.
+            portfolio_label (np.ndarray): 1-D array of integer portfolio labels (0 to p-1), one per sample.
+            outcome (np.ndarray): Array of outcome values for each sample corresponding to portfolio_label.
             weight (np.ndarray, optional): Array of weights used for computing weighted averages. Defaults to None, representing equal weights.
+            p (int, optional): Total number of portfolios, as sized by portfolio_formation. Defaults to the largest observed label plus one, which undercounts when the top portfolios are empty in a period.
 
-        Returns: (turple): 
+        Returns: (turple):
             average_outcome (np.ndarray): Array containing the average values of each portfolio, with each row representing the average value of a portfolio.
             HML_average_outcome (np.ndarry): Difference in the average outcome variable between the highest and lowest portfolios.
 
         Note:
             If no weights are provided (weight is None), equal-weighted portfolios are computed.
         """
-        p = portfolio_label.shape[1]
-        average_outcome = np.zeros((p, 1))
-
-        for i in range(p):
-            if weight is None: # equal-weighted portfolios.
-                average_outcome[i, 0] = np.mean(outcome[np.where(portfolio_label[:, i] == i+1)])
-            else:              # weighted portfolios
-                average_outcome[i, 0] = np.average(outcome[np.where(portfolio_label[:, i] == i+1)], weights=weight)
+        portfolio_label = np.asarray(portfolio_label)
+        if portfolio_label.size and int(portfolio_label.min()) < 0:
+            # Samples with a missing characteristic carry code -1 and belong
+            # to no portfolio, matching the old pd.cut NaN-group exclusion.
+            valid = portfolio_label >= 0
+            portfolio_label = portfolio_label[valid]
+            outcome = np.asarray(outcome)[valid]
+            if weight is not None:
+                weight = np.asarray(weight)[valid]
+        n = portfolio_label.shape[0]
+        if p is None:
+            if n == 0:
+                raise ValueError("portfolio_label contains no non-missing samples, so the portfolio count cannot be inferred; pass p explicitly to get all-NaN averages.")
+            p = int(portfolio_label.max()) + 1
+
+        if n == 0:
+            # Every sample was missing this period: all portfolios are empty,
+            # which the per-portfolio paths below report as NaN.
+            average_outcome = np.full((p, 1), np.nan)
+        elif p > 2 * n:
+            # Sparse code space (e.g. a deep multivariate sort): sort once and
+            # scan group slices with np.add.reduceat instead of filling dense
+            # p-length bincount accumulators that are mostly empty.
+            order = np.argsort(portfolio_label)
+            boundaries = np.searchsorted(portfolio_label[order], np.arange(p + 1))
+            counts = np.diff(boundaries)
+            starts = np.minimum(boundaries[:-1], n - 1)
+            if weight is None:
+                sums = np.add.reduceat(outcome[order], starts)
+                denom = counts
+            else:
+                sums = np.add.reduceat((outcome * weight)[order], starts)
+                denom = np.add.reduceat(weight[order], starts)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                average_outcome = np.where(counts == 0, np.nan, sums / denom).reshape(p, 1)
+        elif weight is None: # equal-weighted portfolios.
+            sums = np.bincount(portfolio_label, weights=outcome, minlength=p)
+            counts = np.bincount(portfolio_label, minlength=p)
+            with np.errstate(invalid='ignore'):  # empty portfolios -> NaN
+                average_outcome = (sums / counts).reshape(p, 1)
+        else:              # weighted portfolios
+            outcome = np.asarray(outcome, dtype=np.float64)
+            weight = np.asarray(weight, dtype=np.float64)
+            if numba is not None:
+                average_outcome = _group_average_kernel(portfolio_label, outcome, weight, p).reshape(p, 1)
+            else:
+                # Scatter-add per portfolio; bincount does what np.add.at
+                # would, in one C pass without per-element ufunc dispatch.
+                num = np.bincount(portfolio_label, weights=outcome * weight, minlength=p)
+                den = np.bincount(portfolio_label, weights=weight, minlength=p)
+                with np.errstate(invalid='ignore', divide='ignore'):  # empty portfolios -> NaN
+                    average_outcome = (num / den).reshape(p, 1)
 
         HML_average_outcome = average_outcome[-1] - average_outcome[0]
 